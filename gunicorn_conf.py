@@ -0,0 +1,13 @@
+import os
+
+# Playlist cache and the ffmpeg slot limit live in-process, so scale with
+# threads inside one worker by default rather than with extra workers.
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+# gthread workers heartbeat from their main loop, so long audio streams are
+# safe under this; it only catches a worker that has genuinely hung
+timeout = 30
+keepalive = 5
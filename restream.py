@@ -1,11 +1,27 @@
 #!/usr/bin/env python3
 import os
+import fcntl
+import re
+import sys
+import gzip
+import json
+import hashlib
 import time
 import logging
 import random
 import requests
 import subprocess
-from flask import Flask, Response, render_template_string, abort, stream_with_context, request
+import tempfile
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, render_template, abort, stream_with_context, request
+try:
+    import orjson  # optional; several times faster for the disk cache
+except ImportError:
+    orjson = None
 
 # ============================================================
 # Basic Setup
@@ -18,8 +34,46 @@ logging.basicConfig(
 app = Flask(__name__)
 
 REFRESH_INTERVAL = 1800
+WARM_WORKERS = 16
 LOGO_FALLBACK = "https://iptv-org.github.io/assets/logo.png"
 
+# Cap concurrent ffmpeg transcodes so extra listeners don't thrash the CPU
+MAX_TRANSCODES = os.cpu_count() or 1
+TRANSCODE_SLOTS = threading.BoundedSemaphore(MAX_TRANSCODES)
+TRANSCODE_WAIT = 10
+# Listeners of the same source share one ffmpeg; audio buffered per listener
+AUDIO_FEEDS = {}
+AUDIO_FEEDS_LOCK = threading.Lock()
+# a listener this many bytes behind (~1 min of 64 kbps audio) is disconnected
+FEED_BACKLOG_BYTES = 512 * 1024
+# Max bytes moved per read when relaying audio
+PROXY_CHUNK = 256 * 1024
+# let ffmpeg run this far ahead of the pump thread (Linux default is 64 KiB)
+FFMPEG_PIPE_SIZE = 1 << 20
+
+# Shorter input probing so the first audio byte isn't held back by ffmpeg's
+# default ~5 s analysis; still long enough to find the audio PID in MPEG-TS.
+# rw_timeout (µs) makes ffmpeg give up on a stalled upstream instead of hanging
+FFMPEG_INPUT_ARGS = ("-fflags", "+nobuffer", "-probesize", "256k", "-analyzeduration", "1000000",
+                     "-rw_timeout", "10000000")
+# ffmpeg output for the default 40 kbps mono mp3 re-encode
+TRANSCODE_ARGS = ("-c:a", "libmp3lame", "-ac", "1", "-ar", "44100", "-b:a", "40k", "-f", "mp3")
+# codec -> (muxer, mimetype) for sources whose audio track can be copied as-is
+COPY_FORMATS = {"aac": ("adts", "audio/aac"), "mp3": ("mp3", "audio/mpeg")}
+COPY_MAX_BITRATE = 64000
+# per-URL probe results; URLs come from clients (/play-audio-direct), so capped
+PROBE_CACHE_SIZE = 512
+# codec probes run in the background, at most this many ffprobes at once
+PROBE_SLOTS = threading.BoundedSemaphore(MAX_TRANSCODES)
+# upstream types relayed as-is (.mp3/.aac/.m4a); anything else goes through ffmpeg
+# so listeners never get flac/wav bitrates or .pls-style playlists
+PASSTHROUGH_TYPES = frozenset((
+    "audio/mpeg", "audio/mp3", "audio/aac", "audio/aacp", "audio/mp4", "audio/x-m4a",
+))
+PROBE_TIMEOUT = 10
+# source URLs ffmpeg just failed on without producing any audio
+DEAD_SOURCE_TTL = 60
+
 # ============================================================
 # PLAYLISTS (QUALITY REMOVED) - UPDATED WITH MANY LANGUAGES
 # ============================================================
@@ -67,124 +121,618 @@ PLAYLISTS = {
     "korean":  "https://iptv-org.github.io/iptv/languages/kor.m3u",
 }
 
-CACHE = {}
+# name -> entry, in least-recently-used order; capped to bound memory
+CACHE = OrderedDict()
+CACHE_LRU_LOCK = threading.Lock()
+MAX_CACHED_PLAYLISTS = 16
+CACHE_LOCKS = {}
+CACHE_LOCKS_GUARD = threading.Lock()
+LIST_PAGES = {}
+LIST_STREAM_BUFFER = 64
+LIST_MAX_AGE = 300
+# HTML smaller than this isn't worth a gzip pass
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 5
+
+# Parsed playlists are mirrored here so a restart doesn't refetch everything
+PLAYLIST_CACHE_DIR = os.path.join(tempfile.gettempdir(), "iptv_playlists")
+
+# Shared session: keeps TLS connections to the playlist CDN / upstreams alive
+SESSION = requests.Session()
+# many distinct stream hosts, and up to one pooled connection per gunicorn thread each
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                       max_retries=Retry(total=2, backoff_factor=0.3))
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate", "User-Agent": "iptv-restream/1"})
 
 # ============================================================
 # M3U PARSER
 # ============================================================
+# key="quoted value" or key=bare-value; keys start after a space or the EXTINF colon
+EXTINF_ATTR_RE = re.compile(r'([^\s:="]+)=(?:"([^"]*)"|(\S*))')
+# .m3u8 at the end of the path, optionally followed by a query string
+_is_hls = re.compile(r"\.m3u8(?:\?|$)", re.I).search
+_stream_ext = re.compile(r"\.(m3u8|webm)(?:\?|$)", re.I).search
+STREAM_MIMES = {"m3u8": "application/vnd.apple.mpegurl", "webm": "video/webm"}
+
+def stream_mime(url: str):
+    m = _stream_ext(url)
+    return STREAM_MIMES[m.group(1).lower()] if m else "video/mp4"
+
+def _title_comma(line: str):
+    # first comma outside a quoted attribute value, e.g. group-title="News,Sports"
+    comma = line.find(",")
+    while comma != -1 and line.count('"', 0, comma) % 2:
+        comma = line.find(",", comma + 1)
+    return comma if comma != -1 else line.find(",")
+
 def parse_extinf(line: str):
-    if "," in line:
-        left, title = line.split(",", 1)
+    comma = _title_comma(line)
+    if comma != -1:
+        left, title = line[:comma], line[comma + 1:]
     else:
         left, title = line, ""
 
-    attrs = {}
-    pos = 0
-    while True:
-        eq = left.find("=", pos)
-        if eq == -1:
-            break
-        key_end = eq
-        key_start = left.rfind(" ", 0, key_end)
-        colon = left.rfind(":", 0, key_end)
-        if colon > key_start:
-            key_start = colon
-        key = left[key_start + 1:key_end].strip()
-
-        if eq + 1 < len(left) and left[eq + 1] == '"':
-            val_start = eq + 2
-            val_end = left.find('"', val_start)
-            if val_end == -1:
-                break
-            val = left[val_start:val_end]
-            pos = val_end + 1
-        else:
-            val_end = left.find(" ", eq + 1)
-            if val_end == -1:
-                val_end = len(left)
-            val = left[eq + 1:val_end].strip()
-            pos = val_end
+    attrs = {key: quoted or bare for key, quoted, bare in EXTINF_ATTR_RE.findall(left)}
+    # parse_m3u already stripped the line, so only the gap after the comma is left
+    return attrs, title.lstrip()
 
-        attrs[key] = val
-    return attrs, title.strip()
+# Tuples instead of per-channel dicts: much smaller for 10k-entry playlists,
+# and Jinja's ch.title etc. still work through the namedtuple attributes
+Channel = namedtuple("Channel", "title url logo group tvg_id mime")
 
-def parse_m3u(text: str):
-    lines = [l.strip() for l in text.splitlines() if l.strip()]
+def parse_m3u(lines):
+    """Parse an iterable of playlist lines (e.g. resp.iter_lines()) in one pass."""
     channels = []
-    i = 0
-    while i < len(lines):
-        if lines[i].startswith("#EXTINF"):
-            attrs, title = parse_extinf(lines[i])
-            j = i + 1
-            url = None
-            while j < len(lines):
-                if not lines[j].startswith("#"):
-                    url = lines[j]
-                    break
-                j += 1
-            if url:
-                channels.append({
-                    "title": title or attrs.get("tvg-name") or "Unknown",
-                    "url": url,
-                    "logo": attrs.get("tvg-logo") or "",
-                    "group": attrs.get("group-title") or "",
-                    "tvg_id": attrs.get("tvg-id") or "",
-                })
-            i = j + 1
-        else:
-            i += 1
-    return channels
+    pending = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if pending is None:
+            if line.startswith("#EXTINF"):
+                pending = line
+            continue
+        # comment/option lines between EXTINF and its URL are skipped
+        if line.startswith("#"):
+            continue
+        attrs, title = parse_extinf(pending)
+        pending = None
+        channels.append(Channel(
+            title or attrs.get("tvg-name") or "Unknown",
+            line,
+            attrs.get("tvg-logo") or "",
+            # a few dozen distinct groups repeat across thousands of rows
+            sys.intern(attrs.get("group-title") or ""),
+            attrs.get("tvg-id") or "",
+            stream_mime(line),
+        ))
+    # shared read-only by every request thread, so hand out an immutable tuple
+    return tuple(channels)
 
 # ============================================================
 # Cache Loader
 # ============================================================
-def get_channels(name: str):
-    now = time.time()
-    cached = CACHE.get(name)
-    if cached and now - cached.get("time", 0) < REFRESH_INTERVAL:
-        return cached["channels"]
+def _is_fresh(entry):
+    return time.time() - entry.get("time", 0) < REFRESH_INTERVAL
+
+def _cache_get(name: str):
+    with CACHE_LRU_LOCK:
+        entry = CACHE.get(name)
+        if entry is not None:
+            CACHE.move_to_end(name)
+        return entry
+
+def _cache_put(name: str, entry):
+    with CACHE_LRU_LOCK:
+        CACHE[name] = entry
+        CACHE.move_to_end(name)
+        # least recently used playlists fall back to the disk cache
+        while len(CACHE) > MAX_CACHED_PLAYLISTS:
+            evicted, _ = CACHE.popitem(last=False)
+            LIST_PAGES.pop(evicted, None)
+            logging.info("[%s] Evicted from memory cache", evicted)
+
+def _cache_lock(name: str):
+    with CACHE_LOCKS_GUARD:
+        return CACHE_LOCKS.setdefault(name, threading.Lock())
+
+def build_search_keys(channels):
+    # one lowercased title/group/url string per channel, parallel to the list,
+    # so /search scans flat strings instead of re-lowering dict fields
+    return ["\n".join((ch.title, ch.group, ch.url)).lower() for ch in channels]
+
+def _disk_cache_path(name: str):
+    return os.path.join(PLAYLIST_CACHE_DIR, name + ".json")
+
+def save_disk_cache(name: str, entry):
+    data = {k: entry.get(k) for k in ("time", "channels", "etag", "last_modified")}
+    path = _disk_cache_path(name)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        os.makedirs(PLAYLIST_CACHE_DIR, exist_ok=True)
+        if orjson:
+            # Channel namedtuples aren't serialized natively; default turns them into arrays
+            payload = orjson.dumps(data, default=tuple)
+        else:
+            payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        with open(tmp, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.error("Disk cache write failed %s: %s", name, e)
+
+def load_disk_cache(name: str):
+    try:
+        with open(_disk_cache_path(name), "rb") as f:
+            raw = f.read()
+        entry = orjson.loads(raw) if orjson else json.loads(raw)
+        rows = entry["channels"]
+        if rows and not isinstance(rows[0], list):
+            raise ValueError("unexpected channel layout")
+        entry["channels"] = tuple(Channel(t, u, logo, sys.intern(g), tid, sys.intern(m))
+                                  for t, u, logo, g, tid, m in rows)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        logging.error("Disk cache read failed %s: %s", name, e)
+        return None
+    entry["search"] = build_search_keys(entry["channels"])
+    logging.info("[%s] Restored %d channels from disk", name, len(entry["channels"]))
+    return entry
+
+def get_search_index(name: str):
+    entry = get_playlist(name)
+    if not entry:
+        return (), []
+    return entry["channels"], entry["search"]
+
+def search_channels(name: str, ql: str):
+    """Indexes of channels in playlist `name` whose search key contains `ql` (lowercase)."""
+    channels, keys = get_search_index(name)
+    return channels, [i for i, key in enumerate(keys) if ql in key]
+
+def get_channels(name: str, refresh: bool = False):
+    entry = get_playlist(name, refresh=refresh)
+    return entry["channels"] if entry else ()
+
+def get_playlist(name: str, refresh: bool = False):
+    """Cache entry for a playlist, fetching it if missing or expired; None if nothing usable."""
+    entry = _cache_get(name)
+    if entry and not refresh and _is_fresh(entry):
+        return entry
 
     url = PLAYLISTS.get(name)
     if not url:
         logging.error("Playlist not found: %s", name)
-        return []
+        return None
 
-    logging.info("[%s] Fetching playlist: %s", name, url)
+    # single-flight: concurrent misses wait for one fetch instead of all fetching;
+    # if an expired copy exists, serve it rather than wait out someone else's refresh
+    lock = _cache_lock(name)
+    if not lock.acquire(blocking=refresh or entry is None):
+        return entry
     try:
-        resp = requests.get(url, timeout=25)
-        resp.raise_for_status()
-        channels = parse_m3u(resp.text)
-        CACHE[name] = {"time": now, "channels": channels}
-        logging.info("[%s] Loaded %d channels", name, len(channels))
-        return channels
-    except Exception as e:
-        logging.error("Load failed %s: %s", name, e)
-        return []
+        stale = _cache_get(name)
+        if stale is None:
+            stale = load_disk_cache(name)
+            if stale:
+                _cache_put(name, stale)
+        if stale and not refresh and _is_fresh(stale):
+            return stale
+
+        # revalidate an expired entry instead of re-downloading it blindly
+        headers = {}
+        if stale:
+            if stale.get("etag"):
+                headers["If-None-Match"] = stale["etag"]
+            if stale.get("last_modified"):
+                headers["If-Modified-Since"] = stale["last_modified"]
+
+        logging.info("[%s] Fetching playlist: %s", name, url)
+        try:
+            with SESSION.get(url, headers=headers, timeout=25, stream=True) as resp:
+                if resp.status_code == 304 and stale:
+                    stale["time"] = time.time()
+                    _cache_put(name, stale)
+                    logging.info("[%s] Playlist unchanged, keeping %d channels", name, len(stale["channels"]))
+                    return stale
+                resp.raise_for_status()
+                # playlists are UTF-8; don't let requests run charset detection over MBs
+                resp.encoding = resp.encoding or "utf-8"
+                channels = parse_m3u(resp.iter_lines(chunk_size=64 * 1024, decode_unicode=True))
+            entry = {
+                "time": time.time(),
+                "channels": channels,
+                "search": build_search_keys(channels),
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+            }
+            _cache_put(name, entry)
+            save_disk_cache(name, entry)
+            logging.info("[%s] Loaded %d channels", name, len(channels))
+            return entry
+        except Exception as e:
+            logging.error("Load failed %s: %s", name, e)
+            # an expired playlist beats an empty page while upstream is down
+            return stale
+    finally:
+        lock.release()
+
+def warm_cache(names, refresh: bool = False):
+    with ThreadPoolExecutor(max_workers=WARM_WORKERS) as ex:
+        list(ex.map(lambda name: get_playlist(name, refresh=refresh), names))
+
+def _cache_warmer():
+    # warm only what the LRU can hold ("all" comes first); the rest load on
+    # first use. Then keep the in-memory ones refreshed on schedule.
+    warm_cache(list(PLAYLISTS)[:MAX_CACHED_PLAYLISTS])
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        with CACHE_LRU_LOCK:
+            names = list(CACHE)
+        warm_cache(names, refresh=True)
+
+threading.Thread(target=_cache_warmer, name="cache-warmer", daemon=True).start()
 
 # ============================================================
 # Audio-only proxy
 # ============================================================
-def proxy_audio_only(source_url: str):
-    cmd = [
-        "ffmpeg", "-loglevel", "error", "-i", source_url,
-        "-vn", "-ac", "1", "-ar", "44100", "-b:a", "40k",
-        "-f", "mp3", "pipe:1",
-    ]
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+class ExpiringLRU:
+    """Thread-safe LRU of at most maxsize entries, each dropped ttl seconds after put()."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            hit = self.items.get(key)
+            if hit is None:
+                return default
+            if time.time() - hit[0] >= self.ttl:
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return hit[1]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.items[key] = (now, value)
+            self.items.move_to_end(key)
+            # prune expired entries from the cold end, then enforce the cap
+            while self.items:
+                stamp = next(iter(self.items.values()))[0]
+                if now - stamp < self.ttl and len(self.items) <= self.maxsize:
+                    break
+                self.items.popitem(last=False)
+
+AUDIO_TYPES = ExpiringLRU(PROBE_CACHE_SIZE, REFRESH_INTERVAL)
+AUDIO_PROBES = ExpiringLRU(PROBE_CACHE_SIZE, REFRESH_INTERVAL)
+DEAD_SOURCES = ExpiringLRU(PROBE_CACHE_SIZE, DEAD_SOURCE_TTL)
+
+def probe_audio_type(source_url: str):
+    """Return the upstream Content-Type if it is mp3/aac audio that can be relayed as-is."""
+    if _is_hls(source_url):
+        return None
+    cached = AUDIO_TYPES.get(source_url)
+    if cached is not None:
+        return cached or None
+    mime = ""
+    try:
+        resp = SESSION.head(source_url, allow_redirects=True, timeout=5)
+        ctype = resp.headers.get("Content-Type", "").split(";", 1)[0].strip().lower()
+        if resp.ok and ctype in PASSTHROUGH_TYPES:
+            mime = ctype
+    except Exception as e:
+        # cached too, so a dead host doesn't cost a HEAD timeout on every retry
+        logging.info("Audio probe failed %s: %s", source_url, e)
+    AUDIO_TYPES.put(source_url, mime)
+    return mime or None
+
+def open_passthrough(source_url: str):
+    """Upstream response for a direct relay, already status-checked; None on failure."""
+    try:
+        resp = SESSION.get(source_url, stream=True, timeout=25)
+    except requests.RequestException as e:
+        logging.error("Audio passthrough failed %s: %s", source_url, e)
+        return None
+    if not resp.ok:
+        logging.error("Audio passthrough failed %s: HTTP %d", source_url, resp.status_code)
+        resp.close()
+        return None
+    return resp
+
+def passthrough_audio(resp):
+    # read1 hands over whatever has arrived (up to PROXY_CHUNK) instead of
+    # waiting for a full chunk the way iter_content does
     try:
         while True:
-            data = proc.stdout.read(64 * 1024)
-            if not data:
+            chunk = resp.raw.read1(PROXY_CHUNK, decode_content=True)
+            if not chunk:
                 break
-            yield data
-    finally:
+            yield chunk
+    except Exception as e:
+        # headers are long gone; all that's left is to end the body
+        logging.info("Audio passthrough ended %s: %s", resp.url, e)
+
+def probe_audio_codec(source_url: str):
+    """(codec, bit_rate) of the first audio stream, cached per URL; ("", 0) if unknown."""
+    cached = AUDIO_PROBES.get(source_url)
+    if cached:
+        return cached
+    # same short analysis and I/O timeout as the ffmpeg that follows
+    cmd = [
+        "ffprobe", "-v", "error", *FFMPEG_INPUT_ARGS, "-select_streams", "a:0",
+        "-show_entries", "stream=codec_name,bit_rate", "-of", "csv=p=0", source_url,
+    ]
+    try:
+        out = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT).stdout
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.info("ffprobe failed %s: %s", source_url, e)
+        out = ""
+    lines = out.strip().splitlines()
+    codec, _, rate = lines[0].partition(",") if lines else ("", "", "")
+    bit_rate = int(rate) if rate.isdigit() else 0
+    AUDIO_PROBES.put(source_url, (codec, bit_rate))
+    return codec, bit_rate
+
+def _probe_later(source_url: str):
+    # skipped when all probe slots are busy; a later play of the URL retries
+    if not PROBE_SLOTS.acquire(blocking=False):
+        return
+
+    def run():
         try:
-            proc.terminate()
-            time.sleep(0.5)
-            if proc.poll() is None:
-                proc.kill()
-        except:
-            pass
+            probe_audio_codec(source_url)
+        finally:
+            PROBE_SLOTS.release()
+
+    threading.Thread(target=run, name="audio-probe", daemon=True).start()
+
+def audio_output(source_url: str):
+    """Mimetype and ffmpeg output args: remux low-bitrate aac/mp3, otherwise transcode.
+
+    Copying needs a cached probe of the URL. Without one, transcode straight away
+    and probe in the background, so no play waits on a serial ffprobe.
+    """
+    probed = AUDIO_PROBES.get(source_url)
+    if probed is None:
+        _probe_later(source_url)
+        return "audio/mpeg", TRANSCODE_ARGS
+    codec, bit_rate = probed
+    muxer = COPY_FORMATS.get(codec)
+    if muxer and 0 < bit_rate <= COPY_MAX_BITRATE:
+        return muxer[1], ("-c:a", "copy", "-f", muxer[0])
+    return "audio/mpeg", TRANSCODE_ARGS
+
+def audio_response(source_url: str, headers=None):
+    # a source that just failed would only fail again after another ffmpeg spawn
+    if DEAD_SOURCES.get(source_url):
+        abort(503)
+    # a feed already playing this URL has done all the probing
+    live = _live_feed(source_url)
+    if live:
+        mime, out_args = live.mime, live.key[1]
+    else:
+        # Skip ffmpeg entirely when the upstream already serves mp3/aac
+        # (the audio generators never touch flask.request, so no stream_with_context)
+        mime = probe_audio_type(source_url)
+        if mime:
+            # open and check upstream before committing to a 200
+            upstream = open_passthrough(source_url)
+            if upstream is None:
+                abort(502)
+            resp = Response(passthrough_audio(upstream), mimetype=mime, headers=headers)
+            resp.call_on_close(upstream.close)
+            return resp
+        mime, out_args = audio_output(source_url)
+    # join (or start) the feed before the response is committed, so a full
+    # house gets a real 503 instead of an empty 200
+    feed, listener = _join_feed(source_url, mime, out_args)
+    if feed is None:
+        abort(Response("Audio proxy busy, try again shortly\n", 503,
+                       headers={"Retry-After": str(TRANSCODE_WAIT)}))
+    resp = Response(proxy_audio_only(feed, listener), mimetype=mime, headers=headers)
+    # runs even if the client goes away before the body is first iterated
+    resp.call_on_close(lambda: feed.leave(listener))
+    return resp
+
+def _spawn_audio_ffmpeg(source_url: str, out_args):
+    # -vn/-sn/-dn: only the audio stream is demuxed and decoded
+    cmd = ["ffmpeg", "-nostdin", "-loglevel", "error", *FFMPEG_INPUT_ARGS, "-i", source_url,
+           "-vn", "-sn", "-dn", *out_args, "-flush_packets", "1", "pipe:1"]
+    # stdout is drained with os.read, so no Python-side buffer; stderr is never
+    # read, and a full stderr pipe would block ffmpeg mid-stream
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, bufsize=0)
+    try:
+        fcntl.fcntl(proc.stdout.fileno(), fcntl.F_SETPIPE_SZ, FFMPEG_PIPE_SIZE)
+    except (AttributeError, OSError):
+        # not Linux, or above /proc/sys/fs/pipe-max-size
+        pass
+    return proc
+
+def _stop_ffmpeg(proc):
+    try:
+        proc.terminate()
+        # returns as soon as ffmpeg exits instead of always sleeping the full grace period
+        try:
+            proc.wait(timeout=0.5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait(timeout=1)
+    except:
+        pass
+
+class FeedListener:
+    """One client's backlog of a feed, bounded in bytes rather than chunks."""
+
+    def __init__(self):
+        self.chunks = deque()
+        self.pending = 0
+        self.lagged = False
+        self.gone = False
+        self.cond = threading.Condition()
+
+    def push(self, data, alone):
+        """Buffer data for this client. While alone() holds, wait for room instead,
+        so a lone listener paces ffmpeg through the pipe like a direct relay."""
+        with self.cond:
+            while not self.gone and self.pending + len(data) > FEED_BACKLOG_BYTES and alone():
+                self.cond.wait(1)
+            if self.gone or self.lagged:
+                return
+            if self.pending + len(data) > FEED_BACKLOG_BYTES:
+                # with other listeners to serve, dropping frames would corrupt the
+                # stream and waiting would stall everyone; cut this client off instead
+                self.lagged = True
+            else:
+                self.chunks.append(data)
+                self.pending += len(data)
+            self.cond.notify_all()
+
+    def pop(self, timeout):
+        """Everything buffered so far as one bytes; b"" on timeout, None once lagged."""
+        with self.cond:
+            if not self.chunks and not self.lagged:
+                self.cond.wait(timeout)
+            if self.lagged:
+                return None
+            data = b"".join(self.chunks)
+            self.chunks.clear()
+            self.pending = 0
+            # wake a pump waiting for room
+            self.cond.notify_all()
+            return data
+
+    def close(self):
+        with self.cond:
+            self.gone = True
+            self.cond.notify_all()
+
+class AudioFeed:
+    """One ffmpeg transcode of a source URL, fanned out to every listener of it."""
+
+    def __init__(self, key, mime, listener):
+        self.key = key
+        self.mime = mime
+        # registered before the pump starts so the first listener gets the opening bytes
+        self.listeners = [listener]
+        self.closed = False
+        self.lock = threading.Lock()
+        self.proc = _spawn_audio_ffmpeg(*key)
+        threading.Thread(target=self._pump, name="audio-feed", daemon=True).start()
+
+    def add(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def leave(self, listener):
+        listener.close()
+        with AUDIO_FEEDS_LOCK, self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+            if self.listeners or self.closed:
+                return
+            self._retire()
+        self._shutdown()
+
+    def _retire(self):
+        # caller holds AUDIO_FEEDS_LOCK and self.lock
+        self.closed = True
+        if AUDIO_FEEDS.get(self.key) is self:
+            del AUDIO_FEEDS[self.key]
+
+    def _shutdown(self):
+        _stop_ffmpeg(self.proc)
+        TRANSCODE_SLOTS.release()
+
+    def _pump(self):
+        # os.read returns whatever ffmpeg has produced so far instead of blocking
+        # in the buffered layer until a full chunk is available
+        fd = self.proc.stdout.fileno()
+        produced = False
+        alone = lambda: len(self.listeners) == 1
+        try:
+            while True:
+                data = os.read(fd, PROXY_CHUNK)
+                if not data:
+                    break
+                produced = True
+                with self.lock:
+                    listeners = list(self.listeners)
+                for listener in listeners:
+                    if listener.lagged:
+                        continue
+                    listener.push(data, alone)
+                    if listener.lagged:
+                        logging.info("Audio listener fell %d bytes behind %s, disconnecting",
+                                     FEED_BACKLOG_BYTES, self.key[0])
+        finally:
+            with AUDIO_FEEDS_LOCK, self.lock:
+                if self.closed:
+                    return
+                self._retire()
+            try:
+                failed = not produced and self.proc.wait(timeout=5) != 0
+            except subprocess.TimeoutExpired:
+                failed = False
+            if failed:
+                logging.error("ffmpeg failed on %s, holding it off for %ds", self.key[0], DEAD_SOURCE_TTL)
+                DEAD_SOURCES.put(self.key[0], True)
+            self._shutdown()
+
+def _live_feed(source_url: str):
+    with AUDIO_FEEDS_LOCK:
+        for (url, _), feed in AUDIO_FEEDS.items():
+            if url == source_url:
+                return feed
+    return None
+
+def _join_feed(source_url: str, mime, out_args):
+    key = (source_url, tuple(out_args))
+    listener = FeedListener()
+    with AUDIO_FEEDS_LOCK:
+        feed = AUDIO_FEEDS.get(key)
+        if feed:
+            feed.add(listener)
+            return feed, listener
+    if not TRANSCODE_SLOTS.acquire(timeout=TRANSCODE_WAIT):
+        logging.error("Audio proxy busy (%d transcodes running)", MAX_TRANSCODES)
+        return None, None
+    with AUDIO_FEEDS_LOCK:
+        feed = AUDIO_FEEDS.get(key)
+        if feed:
+            # another listener started it while we waited for a slot
+            TRANSCODE_SLOTS.release()
+            feed.add(listener)
+        else:
+            try:
+                feed = AudioFeed(key, mime, listener)
+            except OSError as e:
+                TRANSCODE_SLOTS.release()
+                logging.error("ffmpeg spawn failed %s: %s", source_url, e)
+                return None, None
+            AUDIO_FEEDS[key] = feed
+        return feed, listener
+
+def proxy_audio_only(feed, listener):
+    """Relay one listener's share of a feed; audio_response leaves the feed on close."""
+    while True:
+        # read before popping: once closed, the pump has pushed its last bytes
+        done = feed.closed
+        data = listener.pop(timeout=1)
+        if data is None:
+            break
+        if data:
+            yield data
+        elif done:
+            break
 
 # ============================================================
 # HTML TEMPLATES
@@ -218,6 +766,10 @@ a:hover{background:#0f0;color:#000}
 {% endfor %}
 </body>
 </html>"""
+HOME_TEMPLATE = app.jinja_env.from_string(HOME_HTML)
+# PLAYLISTS is fixed at import, so the home page never changes
+HOME_PAGE = HOME_TEMPLATE.render(playlists=PLAYLISTS).encode("utf-8")
+HOME_PAGE_GZ = gzip.compress(HOME_PAGE, compresslevel=GZIP_LEVEL)
 
 LIST_HTML = """<!doctype html>
 <html>
@@ -304,6 +856,7 @@ function addFav(title, url, logo){
 </body>
 </html>
 """
+LIST_TEMPLATE = app.jinja_env.from_string(LIST_HTML)
 
 SEARCH_HTML = """<!doctype html>
 <html>
@@ -377,6 +930,7 @@ document.getElementById('q').addEventListener('keydown', function(e){
 </body>
 </html>
 """
+SEARCH_TEMPLATE = app.jinja_env.from_string(SEARCH_HTML)
 
 WATCH_HTML = """<!doctype html>
 <html>
@@ -452,6 +1006,7 @@ function addFavWatch(){
 </body>
 </html>
 """
+WATCH_TEMPLATE = app.jinja_env.from_string(WATCH_HTML)
 
 FAV_HTML = """<!doctype html>
 <html>
@@ -514,49 +1069,102 @@ loadFavs();
 </body>
 </html>
 """
+FAV_TEMPLATE = app.jinja_env.from_string(FAV_HTML)
 
 # ============================================================
 # ROUTES
 # ============================================================
 
+@app.after_request
+def compress_html(resp):
+    # home and cached list pages already carry their own gzip copy, and streamed
+    # bodies (first list render, audio) can't be compressed up front
+    if (resp.mimetype != "text/html" or resp.status_code != 200 or resp.is_streamed
+            or resp.content_encoding or "gzip" not in request.accept_encodings):
+        return resp
+    body = resp.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return resp
+    resp.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    resp.content_encoding = "gzip"
+    resp.vary.add("Accept-Encoding")
+    return resp
+
 @app.route("/")
 def home():
-    return render_template_string(HOME_HTML, playlists=PLAYLISTS)
+    if "gzip" in request.accept_encodings:
+        resp = Response(HOME_PAGE_GZ, mimetype="text/html")
+        resp.content_encoding = "gzip"
+    else:
+        resp = Response(HOME_PAGE, mimetype="text/html")
+    resp.vary.add("Accept-Encoding")
+    return resp
 
 @app.route("/list/<group>")
 def list_group(group):
     if group not in PLAYLISTS:
         abort(404)
     channels = get_channels(group)
-    return render_template_string(LIST_HTML, group=group, channels=channels, fallback=LOGO_FALLBACK)
+    # rendered page is reused until get_channels hands back a refreshed list
+    cached = LIST_PAGES.get(group)
+    if cached and cached[0] is channels:
+        _, html, etag, html_gz = cached
+        if "gzip" in request.accept_encodings:
+            resp = Response(html_gz, mimetype="text/html")
+            resp.content_encoding = "gzip"
+            etag += "-gz"
+        else:
+            resp = Response(html, mimetype="text/html")
+        resp.set_etag(etag)
+        resp.vary.add("Accept-Encoding")
+        resp.cache_control.public = True
+        resp.cache_control.max_age = LIST_MAX_AGE
+        return resp.make_conditional(request)
+
+    # first render streams so the page head reaches the browser before all cards are built
+    def gen():
+        parts = []
+        stream = LIST_TEMPLATE.stream(group=group, channels=channels, fallback=LOGO_FALLBACK)
+        stream.enable_buffering(LIST_STREAM_BUFFER)
+        for chunk in stream:
+            # keep the encoded bytes so cached hits don't re-encode the whole page
+            data = chunk.encode("utf-8")
+            parts.append(data)
+            yield data
+        html = b"".join(parts)
+        etag = hashlib.blake2b(html, digest_size=8).hexdigest()
+        LIST_PAGES[group] = (channels, html, etag, gzip.compress(html, compresslevel=GZIP_LEVEL))
+
+    resp = Response(stream_with_context(gen()), mimetype="text/html")
+    resp.vary.add("Accept-Encoding")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = LIST_MAX_AGE
+    return resp
 
 @app.route("/favourites")
 def favourites():
-    return render_template_string(FAV_HTML)
+    return render_template(FAV_TEMPLATE)
 
 @app.route("/search")
 def search():
     q = request.args.get("q", "").strip()
     # if no query, show page with empty results
     if not q:
-        return render_template_string(SEARCH_HTML, query="", results=[], fallback=LOGO_FALLBACK)
+        return render_template(SEARCH_TEMPLATE, query="", results=[], fallback=LOGO_FALLBACK)
 
     ql = q.lower()
-    # search in the 'all' playlist for a flat list
-    all_channels = get_channels("all")
+    # search in the 'all' playlist for a flat list (title, group or url)
+    all_channels, matches = search_channels("all", ql)
     results = []
-    for idx, ch in enumerate(all_channels):
-        title = (ch.get("title") or "").lower()
-        group = (ch.get("group") or "").lower()
-        # match against title or group or url
-        if ql in title or ql in group or ql in (ch.get("url") or "").lower():
-            results.append({
-                "index": idx,
-                "title": ch.get("title"),
-                "url": ch.get("url"),
-                "logo": ch.get("logo"),
-            })
-    return render_template_string(SEARCH_HTML, query=q, results=results, fallback=LOGO_FALLBACK)
+    for idx in matches:
+        ch = all_channels[idx]
+        results.append({
+            "index": idx,
+            "title": ch.title,
+            "url": ch.url,
+            "logo": ch.logo,
+        })
+    return render_template(SEARCH_TEMPLATE, query=q, results=results, fallback=LOGO_FALLBACK)
 
 @app.route("/random")
 def random_global():
@@ -564,9 +1172,7 @@ def random_global():
     if not channels:
         abort(404)
     ch = random.choice(channels)
-    url = ch["url"]
-    mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=ch, mime_type=mime)
+    return render_template(WATCH_TEMPLATE, channel=ch, mime_type=ch.mime)
 
 @app.route("/random/<group>")
 def random_category(group):
@@ -576,9 +1182,7 @@ def random_category(group):
     if not channels:
         abort(404)
     ch = random.choice(channels)
-    url = ch["url"]
-    mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=ch, mime_type=mime)
+    return render_template(WATCH_TEMPLATE, channel=ch, mime_type=ch.mime)
 
 @app.route("/watch/<group>/<int:idx>")
 def watch_channel(group, idx):
@@ -588,9 +1192,7 @@ def watch_channel(group, idx):
     if idx < 0 or idx >= len(channels):
         abort(404)
     ch = channels[idx]
-    url = ch["url"]
-    mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=ch, mime_type=mime)
+    return render_template(WATCH_TEMPLATE, channel=ch, mime_type=ch.mime)
 
 @app.route("/play-audio/<group>/<int:idx>")
 def play_channel_audio(group, idx):
@@ -601,12 +1203,8 @@ def play_channel_audio(group, idx):
         abort(404)
     ch = channels[idx]
 
-    def gen():
-        for chunk in proxy_audio_only(ch["url"]):
-            yield chunk
-
     headers = {"Access-Control-Allow-Origin": "*"}
-    return Response(stream_with_context(gen()), mimetype="audio/mpeg", headers=headers)
+    return audio_response(ch.url, headers=headers)
 
 @app.route("/watch/fav/<int:index>")
 def watch_fav(index):
@@ -615,8 +1213,7 @@ def watch_fav(index):
     except IndexError:
         return "Favorite not found", 404
 
-    mime_type = "application/x-mpegURL" if channel['url'].endswith('.m3u8') else "video/mp4"
-    return render_template_string(WATCH_HTML, channel=channel, mime_type=mime_type)
+    return render_template(WATCH_TEMPLATE, channel=channel, mime_type=stream_mime(channel['url']))
 
 
 @app.route("/play-audio/fav/<int:index>")
@@ -633,8 +1230,7 @@ def play_audio_direct():
     u = request.args.get("u")
     if not u:
         abort(404)
-    return Response(stream_with_context(proxy_audio_only(u)),
-                    mimetype="audio/mpeg")
+    return audio_response(u)
 
 @app.route("/watch-direct")
 def watch_direct():
@@ -645,7 +1241,7 @@ def watch_direct():
     if not url:
         return "Invalid URL", 400
 
-    mime = "application/vnd.apple.mpegurl" if ".m3u8" in url else "video/mp4"
+    mime = stream_mime(url)
 
     channel = {
         "title": title,
@@ -653,7 +1249,7 @@ def watch_direct():
         "logo": logo
     }
 
-    return render_template_string(WATCH_HTML, channel=channel, mime_type=mime)
+    return render_template(WATCH_TEMPLATE, channel=channel, mime_type=mime)
 
 # ============================================================
 # Entry